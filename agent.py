@@ -1,36 +1,123 @@
 import ast
+import asyncio
+import itertools
 import json
-from collections import defaultdict
-from collections.abc import AsyncIterator
-from dataclasses import dataclass, field
+import math
+from collections import Counter, defaultdict
+from collections.abc import AsyncIterator, Callable
+from dataclasses import asdict, dataclass, field
+from enum import StrEnum, auto
 from pathlib import Path
-from typing import Any
+from typing import Any, Self
 
 import kuzu
 import lancedb
+import logfire
 from pydantic_ai import (
     Agent,
     CallToolsNode,
     ModelRequestNode,
+    ModelRetry,
     RunContext,
     Tool,
     UserPromptNode,
 )
 from pydantic_ai.messages import (
     ModelResponse,
+    RetryPromptPart,
     TextPart,
     ToolCallPart,
     ToolReturnPart,
 )
 from pydantic_ai.result import FinalResult
+from pydantic_ai.usage import Usage
 from pydantic_graph.nodes import End
 from rich import print
 
-from model import AgentType, Config, LLMCitation, LLMResult
-from result import CheckedResult
+from graph import CSRGraph
+from model import (
+    AgentType,
+    Config,
+    FragmentsResult,
+    GraphBackend,
+    LLMCitation,
+    LLMResult,
+)
+from prefetch import Prefetcher
+from result import RE_REFERENCE, CheckedResult
 
 type ActualAgent = Agent[Deps, LLMResult] | Agent[Deps, str]
 
+# Graph tools can time out a few times in a row before the run fails.
+GRAPH_TOOL_RETRIES = 3
+
+
+class RunStopped(Exception):
+    """Raised to stop a run early, such as when it uses too many tools."""
+
+
+class RunOutcome(StrEnum):
+    COMPLETED = auto()
+    STOPPED = auto()
+    FAILED = auto()
+    # The consumer went away (closed tab, new search, dropped connection).
+    ABANDONED = auto()
+
+
+# How runs in this process ended.
+RUN_OUTCOMES: Counter[RunOutcome] = Counter()
+
+
+# Running estimate of the duplicate rate in the phrases table, used to size
+# the over-fetch. It lives as long as the process, so that it adapts across
+# runs rather than starting over for each one.
+@dataclass
+class DuplicateRate:
+    # We start by assuming half of the rows are double ups.
+    rate: float = 0.5
+
+    def update(self, fetched: int, unique: int):
+        if fetched == 0:
+            return
+        rate = 1 - unique / fetched
+        # Exponential moving average, so one odd query does not swing it.
+        self.rate = 0.7 * self.rate + 0.3 * rate
+
+
+DUPLICATE_RATE = DuplicateRate()
+
+
+# Counts of what each tool fetched versus what it handed to the model.
+@dataclass
+class ToolStats:
+    calls: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    fetched: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    returned: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # Calls that counted what they fetched (the graph tools may not).
+    measured: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+    def record(self, tool: str, fetched: int | None, returned: int):
+        self.calls[tool] += 1
+        self.returned[tool] += returned
+        if fetched is not None:
+            self.measured[tool] += 1
+            self.fetched[tool] += fetched
+
+    def averages(self) -> dict[str, tuple[float | None, float]]:
+        """Average (fetched, returned) citations per call, by tool.
+
+        Fetched is None for a tool that never counted it.
+        """
+        return {
+            tool: (
+                self.fetched[tool] / self.measured[tool]
+                if self.measured[tool]
+                else None,
+                self.returned[tool] / n,
+            )
+            for tool, n in self.calls.items()
+        }
+
 
 # Wrapper for Deps for LLM agent.
 @dataclass(kw_only=True)
@@ -39,30 +126,165 @@ class Deps:
     kuzudb: kuzu.Connection
     phrase_limit: int = 20
     link_limit: int = 20
+    neighbourhood_limit: int = 40
+    # Stop semantic results beyond this distance (None means no cutoff).
+    distance_cutoff: float | None = None
+    # Stop semantic results at a jump in distance larger than this.
+    distance_gap: float | None = None
+    # Shared by every run in the process (see DuplicateRate).
+    duplicates: DuplicateRate = field(default_factory=lambda: DUPLICATE_RATE)
+    # A table deduplicated by maintain.py needs no over-fetch.
+    phrases_deduped: bool = False
+    # Lance index cache entries for the phrases table (0 is the default).
+    index_cache_entries: int = 0
+    # Count every match of the kuzu graph tools, before the link limit.
+    count_matches: bool = False
+    stats: ToolStats = field(default_factory=ToolStats)
+    # Every citation the tools returned, for a run that stops early.
+    found: dict[str, LLMCitation] = field(default_factory=dict)
+    max_tool_calls: int = 20
+    tool_calls: int = 0
+    # Queries on one kuzu connection run one at a time.
+    kuzu_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Optional background traversals of semantic search results.
+    prefetcher: Prefetcher | None = None
+    # Optional in-memory graph for get_linked and get_referrers.
+    graph: CSRGraph | None = None
+
+    def phrases(self) -> lancedb.table.Table:
+        return self.lancedb.open_table(
+            "phrases", index_cache_size=self.index_cache_entries or None
+        )
+
+    def use_tool_call(self):
+        self.tool_calls += 1
+        if self.tool_calls > self.max_tool_calls:
+            raise RunStopped(f"it used more than {self.max_tool_calls} tool calls")
+
+    def record(self, tool: str, fetched: int | None, citations: list[LLMCitation]):
+        """Count a tool call, and keep the citations it returned.
+
+        Fetched is how many matched before any limit (None if not counted).
+        """
+        self.stats.record(tool, fetched, len(citations))
+        for cite in citations:
+            self.found.setdefault(cite.reference, cite)
+
+    def phrase_fetch_limit(self) -> int:
+        """How many rows to ask for to get phrase_limit unique ones."""
+        if self.phrases_deduped:
+            return self.phrase_limit
+        rate = min(self.duplicates.rate, 0.9)
+        return math.ceil(self.phrase_limit / (1 - rate)) + 1
+
+    def update_duplicate_rate(self, fetched: int, unique: int):
+        if not self.phrases_deduped:
+            self.duplicates.update(fetched, unique)
+
+
+def open_databases(cf: Config) -> tuple[lancedb.DBConnection, kuzu.Database]:
+    """Open both databases within the memory budgets in the config.
+
+    The lance index cache is sized per table, see `Deps.phrases`.
+    """
+    db = lancedb.connect(cf.lance_path)
+    # Zero means the kuzu default for both.
+    kdb = kuzu.Database(
+        cf.kuzu_path,
+        buffer_pool_size=cf.kuzu_buffer_pool_size,
+        max_num_threads=cf.kuzu_max_threads,
+        read_only=cf.kuzu_read_only,
+    )
+    return db, kdb
+
+
+# Shared database handles, so that a long running server does not
+# reopen the databases for every query.
+@dataclass(kw_only=True)
+class DatabasePool:
+    lancedb: lancedb.DBConnection
+    kuzudb: kuzu.Database
+
+    @classmethod
+    def from_config(cls, cf: Config) -> Self:
+        # Read-only lets several worker processes open the same kuzu files.
+        db, kdb = open_databases(cf.model_copy(update={"kuzu_read_only": True}))
+        # Build (or map) the CSR graph now, rather than on the first query.
+        get_graph(cf, kdb)
+        return cls(lancedb=db, kuzudb=kdb)
+
+
+# The CSR graph is read-only, so one copy serves every run in the process.
+_graphs: dict[Path, CSRGraph] = {}
+
+
+def get_graph(cf: Config, kdb: kuzu.Database) -> CSRGraph | None:
+    """The CSR graph, if that is the configured backend."""
+    if cf.graph_backend != GraphBackend.CSR:
+        return None
+    path = cf.csr_path or cf.kuzu_path
+    if path not in _graphs:
+        with logfire.span("load CSR graph", path=path):
+            if cf.csr_path is not None:
+                _graphs[path] = CSRGraph.load(cf.csr_path)
+            else:
+                _graphs[path] = CSRGraph.from_kuzu(kuzu.Connection(kdb))
+    return _graphs[path]
+
+
+def relevance_cutoff(
+    records: list[dict[str, Any]], cutoff: float | None, gap: float | None
+) -> list[dict[str, Any]]:
+    """Truncate records (sorted by distance) that are no longer relevant.
+
+    We always keep the first record, then stop when the distance passes the
+    cutoff, or when it jumps by more than the gap from the previous record.
+    """
+    kept = records[:1]
+    for prev, rec in itertools.pairwise(records):
+        distance = rec.get("_distance")
+        if distance is None:
+            kept.append(rec)
+            continue
+        if cutoff is not None and distance > cutoff:
+            break
+        if gap is not None and distance - prev.get("_distance", distance) > gap:
+            break
+        kept.append(rec)
+    return kept
 
 
 async def get_legislation(ctx: RunContext[Deps], query: str) -> list[LLMCitation]:
     """Use a semantic lookup for legislation base on phrase."""
-    table = ctx.deps.lancedb.open_table("phrases")
-    results = table.search(query)
-    # TODO: Figure out we get double ups.
-    # For now, we just ask for twice as many and then de-dup.
-    lst = results.limit(ctx.deps.phrase_limit * 2).to_list()
-    cites = []
+    deps = ctx.deps
+    deps.use_tool_call()
+    limit = deps.phrase_fetch_limit()
+
+    def search() -> list[dict[str, Any]]:
+        table = deps.phrases()
+        return table.search(query).limit(limit).to_list()
+
+    # Tables built before `maintain.py --dedup` have double ups, so we
+    # over-fetch based on the duplicates we have seen, then de-dup.
+    # The search runs in a thread, so the run can be cancelled while it waits.
+    lst = await asyncio.to_thread(search)
+    unique = []
     seen = set()
     for rec in lst:
         ident = rec["id"]
         if ident not in seen:
-            cites.append(
-                LLMCitation(
-                    # act
-                    reference=rec["id"],
-                    text=rec["text"],
-                )
-            )
+            unique.append(rec)
             seen.add(ident)
-        if len(cites) >= ctx.deps.phrase_limit:
-            break
+    deps.update_duplicate_rate(len(lst), len(unique))
+
+    relevant = relevance_cutoff(unique, deps.distance_cutoff, deps.distance_gap)
+    cites = [
+        LLMCitation(reference=rec["id"], text=rec["text"])
+        for rec in relevant[: deps.phrase_limit]
+    ]
+    if deps.prefetcher is not None:
+        deps.prefetcher.schedule([cite.reference for cite in cites])
+    deps.record("get_legislation", len(unique), cites)
     return cites
 
 
@@ -90,40 +312,314 @@ def run_cypher(
     return citations
 
 
+def run_count(kuzudb: kuzu.Connection, cypher: str, reference_id: str) -> int:
+    results = kuzudb.execute(kuzudb.prepare(cypher), parameters={"key": reference_id})
+    assert not isinstance(results, list)
+    return results.get_next()[0]
+
+
+async def run_kuzu[T](deps: Deps, fn: Callable[..., T], *args: Any) -> T:
+    """Run a blocking kuzu query in a thread, so the run can be cancelled.
+
+    A cancelled run interrupts the connection to stop the query itself.
+    A query that times out goes back to the model, which can try again.
+    """
+    async with deps.kuzu_lock:
+        try:
+            return await asyncio.to_thread(fn, deps.kuzudb, *args)
+        except RuntimeError as e:
+            # Kuzu reports both timeouts and interrupts this way.
+            if "interrupted" in str(e).lower():
+                raise ModelRetry(
+                    "The graph query took too long. "
+                    "Try fewer reference ids, or a smaller depth."
+                ) from e
+            raise
+
+
+async def take_prefetched(
+    deps: Deps, tool: str, reference_id: str
+) -> list[LLMCitation] | None:
+    if deps.prefetcher is None:
+        return None
+    return await deps.prefetcher.take(tool, reference_id)
+
+
+def get_prefetcher(
+    kuzudb: kuzu.Connection, cf: Config, tool_lock: asyncio.Lock
+) -> Prefetcher:
+    """Prefetch the same traversals that get_linked and get_referrers run."""
+    return Prefetcher(
+        kuzudb=kuzudb,
+        tool_lock=tool_lock,
+        traversals={
+            "get_linked": lambda conn, ident: run_cypher(
+                conn, CYPHER_LINKS, ident, cf.link_limit
+            ),
+            "get_referrers": lambda conn, ident: run_cypher(
+                conn, CYPHER_REFERRERS, ident, cf.link_limit
+            ),
+        },
+        top_n=cf.prefetch_top_n,
+        ttl=cf.prefetch_ttl,
+    )
+
+
+# Both queries rank by the number of reference paths to each fragment,
+# which is cheap to count and puts the most cited text first. Name and
+# phrase break ties, so the order is the same every time (and in graph.py).
 CYPHER_LINKS = """
     MATCH (f:Fragment)-[Refers_to]->(s:Section)<-[Child_of*]-(f2:Fragment)
     where f.name = $key
-    return f2.name as name, f2.phrase as phrase, f2.heads as headings
+    and f2.name <> $key
+    return f2.name as name, f2.phrase as phrase, count(*) as refs
+    order by refs desc, name, phrase
     limit $link_limit
 """
 
 
+# The same matches, counted before the limit (for the tool stats).
+CYPHER_LINKS_COUNT = """
+    MATCH (f:Fragment)-[Refers_to]->(s:Section)<-[Child_of*]-(f2:Fragment)
+    where f.name = $key
+    and f2.name <> $key
+    return count(distinct f2.name)
+"""
+
+
+async def traverse(
+    deps: Deps, tool: str, cypher: str, count_cypher: str, reference_id: str
+) -> list[LLMCitation]:
+    """Run get_linked or get_referrers in kuzu, unless it was prefetched.
+
+    Counting the matches before the limit is a second query, so it only
+    runs with count_matches set; otherwise fetched is not recorded.
+    """
+    citations = await take_prefetched(deps, tool, reference_id)
+    if citations is None:
+        citations = await run_kuzu(
+            deps, run_cypher, cypher, reference_id, deps.link_limit
+        )
+    fetched = None
+    if deps.count_matches:
+        fetched = await run_kuzu(deps, run_count, count_cypher, reference_id)
+    deps.record(tool, fetched, citations)
+    return citations
+
+
 async def get_linked(ctx: RunContext[Deps], reference_id: str) -> list[LLMCitation]:
     """Use a graph database to find links to reference_id legislation."""
-    citations = run_cypher(
-        ctx.deps.kuzudb, CYPHER_LINKS, reference_id, ctx.deps.link_limit
+    deps = ctx.deps
+    deps.use_tool_call()
+    if deps.graph is not None:
+        nodes, counts = deps.graph.link_counts(reference_id)
+        citations = deps.graph.ranked(nodes, counts, deps.link_limit)
+        deps.record("get_linked", deps.graph.count_names(nodes), citations)
+        return citations
+    return await traverse(
+        deps, "get_linked", CYPHER_LINKS, CYPHER_LINKS_COUNT, reference_id
     )
-    return citations
 
 
 CYPHER_REFERRERS = """
-    MATCH (f:Fragment)-[Refers_to]->(s:Section)<-[Child_of*]-(f2:Fragment) 
+    MATCH (f:Fragment)-[Refers_to]->(s:Section)<-[Child_of*]-(f2:Fragment)
     where f2.name = $key
     and split_part(f2.name, '-', 1) <> split_part(f.name, '-', 1)
-    return f.name as name, f.phrase as phrase, f.heads as headings
+    return f.name as name, f.phrase as phrase, count(*) as refs
+    order by refs desc, name, phrase
     limit $link_limit
 """
 
 
+CYPHER_REFERRERS_COUNT = """
+    MATCH (f:Fragment)-[Refers_to]->(s:Section)<-[Child_of*]-(f2:Fragment)
+    where f2.name = $key
+    and split_part(f2.name, '-', 1) <> split_part(f.name, '-', 1)
+    return count(distinct f.name)
+"""
+
+
 async def get_referrers(ctx: RunContext[Deps], reference_id: str) -> list[LLMCitation]:
     """Use a graph database to find all legal text that referes to this reference_id."""
-    citations = run_cypher(
-        ctx.deps.kuzudb, CYPHER_REFERRERS, reference_id, ctx.deps.link_limit
+    deps = ctx.deps
+    deps.use_tool_call()
+    if deps.graph is not None:
+        nodes, counts = deps.graph.referrer_counts(reference_id)
+        citations = deps.graph.ranked(nodes, counts, deps.link_limit)
+        deps.record("get_referrers", deps.graph.count_names(nodes), citations)
+        return citations
+    return await traverse(
+        deps, "get_referrers", CYPHER_REFERRERS, CYPHER_REFERRERS_COUNT, reference_id
     )
+
+
+# Deeper neighbourhoods grow too quickly to be useful.
+NEIGHBOURHOOD_MAX_DEPTH = 2
+# One hop, matching any relationship like CYPHER_LINKS and CYPHER_REFERRERS,
+# so that depth 1 finds the same fragments as get_linked and get_referrers.
+CYPHER_HOP = "-[]->(:Section)<-[*]-"
+
+
+def cypher_keys(reference_ids: list[str]) -> str:
+    """A Cypher list literal of reference ids, which must match RE_REFERENCE."""
+    return "[" + ", ".join(f"'{ref}'" for ref in reference_ids) + "]"
+
+
+def neighbourhood_cypher(reference_ids: list[str], depth: int, limit: int) -> str:
+    """Build one query for the links and referrers at each depth up to depth.
+
+    Links start at the keys, referrers end at them (from other acts), as in
+    CYPHER_LINKS and CYPHER_REFERRERS. Kuzu crashes on parameters in a UNION,
+    so the (already validated) keys and limit are written into the query.
+    """
+    keys = cypher_keys(reference_ids)
+    branches = []
+    for d in range(1, depth + 1):
+        middle = "".join(f"{CYPHER_HOP}(n{i}:Fragment)" for i in range(1, d))
+        chain = f"(f:Fragment){middle}{CYPHER_HOP}(f2:Fragment)"
+        branches.append(f"""
+    MATCH {chain}
+    where f.name in {keys}
+    and not f2.name in {keys}
+    return f2.name as name, f2.phrase as phrase, {d} as depth, count(*) as refs
+    order by refs desc, name, phrase
+    limit {limit}
+""")
+        branches.append(f"""
+    MATCH {chain}
+    where f2.name in {keys}
+    and not f.name in {keys}
+    and split_part(f2.name, '-', 1) <> split_part(f.name, '-', 1)
+    return f.name as name, f.phrase as phrase, {d} as depth, count(*) as refs
+    order by refs desc, name, phrase
+    limit {limit}
+""")
+    return "UNION ALL".join(branches)
+
+
+def run_neighbourhood(
+    kuzudb: kuzu.Connection, reference_ids: list[str], depth: int, limit: int
+) -> list[LLMCitation]:
+    valid = [ref for ref in reference_ids if RE_REFERENCE.fullmatch(ref)]
+    if not valid:
+        return []
+    results = kuzudb.execute(neighbourhood_cypher(valid, depth, limit))
+    assert not isinstance(results, list)
+    # Keep the nearest hop for each fragment, ranked by reference count.
+    found: dict[str, tuple[str, int, int]] = {}
+    while results.has_next():
+        name, phrase, d, refs = results.get_next()
+        best = found.get(name)
+        if best is None or (d, -refs) < (best[1], -best[2]):
+            found[name] = (phrase, d, refs)
+    # Name breaks ties, as in the Cypher, so the same query gives the same
+    # fragments every time.
+    ranked = sorted(found.items(), key=lambda kv: (kv[1][1], -kv[1][2], kv[0]))
+    ranked = ranked[:limit]
+
+    by_act: dict[str, list[LLMCitation]] = defaultdict(list)
+    for name, (phrase, _, _) in ranked:
+        by_act[name.split("-")[0]].append(LLMCitation(reference=name, text=phrase))
+    return [cite for cites in by_act.values() for cite in cites]
+
+
+async def get_neighbourhood(
+    ctx: RunContext[Deps], reference_ids: list[str], depth: int = 1
+) -> list[LLMCitation]:
+    """Use a graph database to find both the links and the referrers of several
+    reference_ids at once, up to depth (1 or 2) hops away. Results are grouped by act.
+    """
+    ctx.deps.use_tool_call()
+    depth = max(1, min(depth, NEIGHBOURHOOD_MAX_DEPTH))
+    citations = await run_kuzu(
+        ctx.deps, run_neighbourhood, reference_ids, depth, ctx.deps.neighbourhood_limit
+    )
+    ctx.deps.record("get_neighbourhood", len(citations), citations)
     return citations
 
 
-def parse_dict(data: str | dict[str, Any]) -> dict[str, str]:
+def lookup_fragments(
+    table: lancedb.table.Table, reference_ids: list[str]
+) -> dict[str, str]:
+    """Fetch the text of each reference id in one filtered lookup."""
+    quoted = ", ".join(f"'{ref}'" for ref in reference_ids)
+    where = f"id IN ({quoted})"
+    has_aliases = "aliases" in table.schema.names
+    if has_aliases:
+        where += f" OR array_has_any(aliases, [{quoted}])"
+    texts = {}
+    wanted = set(reference_ids)
+    for rec in table.search().where(where).limit(None).to_list():
+        texts[rec["id"]] = rec["text"]
+        # A deduplicated row answers for its aliases too.
+        for alias in rec.get("aliases") or []:
+            if alias in wanted:
+                texts[alias] = rec["text"]
+    return texts
+
+
+def context_cypher(reference_ids: list[str], limit: int) -> str:
+    """Other fragments in the nearest section (up to two up) of each key that
+    has any. As with neighbourhood_cypher, kuzu mishandles parameters here, so
+    the (already validated) keys and limit are written into the query.
+    """
+    keys = cypher_keys(reference_ids)
+    return f"""
+    MATCH (f:Fragment)-[c:Child_of*1..2]->(:Section)<-[:Child_of*]-(f2:Fragment)
+    where f.name in {keys}
+    and not f2.name in {keys}
+    with f, min(length(c)) as nearest
+    MATCH (f)-[c2:Child_of*1..2]->(:Section)<-[:Child_of*]-(f3:Fragment)
+    where length(c2) = nearest
+    and not f3.name in {keys}
+    return distinct f3.name as name, f3.phrase as phrase
+    order by name
+    limit {limit}
+"""
+
+
+def run_context(
+    kuzudb: kuzu.Connection, reference_ids: list[str], limit: int
+) -> list[LLMCitation]:
+    results = kuzudb.execute(context_cypher(reference_ids, limit))
+    assert not isinstance(results, list)
+    citations = []
+    while results.has_next():
+        name, phrase = results.get_next()
+        citations.append(LLMCitation(reference=name, text=phrase))
+    return citations
+
+
+async def get_fragments(
+    ctx: RunContext[Deps], reference_ids: list[str], with_context: bool = False
+) -> FragmentsResult:
+    """Fetch the full text of several reference_ids you have already seen.
+    Set with_context to also get the rest of the sections they belong to.
+    """
+    deps = ctx.deps
+    deps.use_tool_call()
+    ids = list(dict.fromkeys(reference_ids))
+    # Past the limit, the model is told to ask again.
+    ids, not_fetched = ids[: deps.phrase_limit], ids[deps.phrase_limit :]
+    valid = [ref for ref in ids if RE_REFERENCE.fullmatch(ref)]
+    texts = {}
+    if valid:
+        texts = await asyncio.to_thread(lambda: lookup_fragments(deps.phrases(), valid))
+
+    found = [ref for ref in ids if ref in texts]
+    result = FragmentsResult(
+        citations=[LLMCitation(reference=ref, text=texts[ref]) for ref in found],
+        invalid=[ref for ref in ids if ref not in texts],
+        not_fetched=not_fetched,
+    )
+    if with_context and found:
+        result.context = await run_kuzu(deps, run_context, found, deps.link_limit)
+    fetched = result.citations + result.context
+    deps.record("get_fragments", len(fetched), fetched)
+    return result
+
+
+def parse_dict(data: str | dict[str, Any]) -> dict[str, Any]:
     """A helper function to parse a string or dict into a dict."""
     if isinstance(data, dict):
         return data
@@ -145,6 +641,8 @@ class OngoingResult:
     summary: str = ""
     final: str = ""
     complete: bool = False
+    # Why the run stopped early, if it did.
+    stopped: str = ""
 
 
 @dataclass
@@ -154,6 +652,10 @@ class AgentRunner:
     references: dict[str, LLMCitation] = field(default_factory=dict)
     # Keep the call around till we get a return.
     tool_calls: dict[str, ToolCallData] = field(default_factory=dict)
+    # Optional shared databases (see api.py).
+    pool: DatabasePool | None = None
+    # Model requests made, once the run completes.
+    model_turns: int = 0
 
     def get_prompt(self) -> str:
         pth = Path.cwd() / self.config.agent_type.name.lower()
@@ -162,9 +664,14 @@ class AgentRunner:
     def get_agent(self) -> ActualAgent:
         tools = [
             Tool(get_legislation, takes_ctx=True),
-            Tool(get_linked, takes_ctx=True),
-            Tool(get_referrers, takes_ctx=True),
+            Tool(get_linked, takes_ctx=True, max_retries=GRAPH_TOOL_RETRIES),
+            Tool(get_referrers, takes_ctx=True, max_retries=GRAPH_TOOL_RETRIES),
+            Tool(get_fragments, takes_ctx=True, max_retries=GRAPH_TOOL_RETRIES),
         ]
+        if self.config.use_neighbourhood:
+            tools.append(
+                Tool(get_neighbourhood, takes_ctx=True, max_retries=GRAPH_TOOL_RETRIES)
+            )
         prompt = self.get_prompt()
         match self.config.agent_type:
             case AgentType.GPT:
@@ -198,12 +705,108 @@ class AgentRunner:
             text.append(f"- {t} ({by_title[t]})")
         return "\n".join(text)
 
-    def get_deps(self) -> Deps:
+    async def get_deps(self) -> Deps:
+        """Set up the tools' dependencies, without blocking the event loop."""
         cf = self.config
-        db = lancedb.connect(cf.lance_path)
-        kdb = kuzu.Database(cf.kuzu_path)
+        if self.pool is not None:
+            db, kdb = self.pool.lancedb, self.pool.kuzudb
+        else:
+            db, kdb = await asyncio.to_thread(open_databases, cf)
+        # Kuzu connections are not shared between concurrent runs.
         kuzudb = kuzu.Connection(kdb)
-        return Deps(lancedb=db, kuzudb=kuzudb)
+        kuzudb.set_query_timeout(cf.kuzu_query_timeout)
+        graph = await asyncio.to_thread(get_graph, cf, kdb)
+        kuzu_lock = asyncio.Lock()
+        prefetcher = None
+        # The CSR graph answers in well under a millisecond, so there is
+        # nothing to gain from prefetching.
+        if cf.prefetch_top_n > 0 and graph is None:
+            # Prefetching gets its own connection, so it never blocks a tool,
+            # and waits on the tools' lock so it only runs while they are idle.
+            prefetch_db = kuzu.Connection(kdb)
+            prefetch_db.set_query_timeout(cf.kuzu_query_timeout)
+            prefetcher = get_prefetcher(prefetch_db, cf, kuzu_lock)
+        deduped = await asyncio.to_thread(
+            lambda: "aliases" in db.open_table("phrases").schema.names
+        )
+        return Deps(
+            lancedb=db,
+            kuzudb=kuzudb,
+            kuzu_lock=kuzu_lock,
+            phrase_limit=cf.phrase_limit,
+            link_limit=cf.link_limit,
+            neighbourhood_limit=cf.neighbourhood_limit,
+            distance_cutoff=cf.distance_cutoff,
+            distance_gap=cf.distance_gap,
+            max_tool_calls=cf.max_tool_calls,
+            prefetcher=prefetcher,
+            graph=graph,
+            phrases_deduped=deduped,
+            index_cache_entries=cf.lance_index_cache_entries,
+            count_matches=cf.count_graph_matches,
+        )
+
+    def log_stats(self, deps: Deps, usage: Usage):
+        """Report the model turns, and the citations per tool call."""
+        self.model_turns = usage.requests
+        logfire.info("model turns: {turns}", turns=usage.requests)
+        for tool, (fetched, returned) in deps.stats.averages().items():
+            # Without count_graph_matches, the kuzu graph tools do not count.
+            logfire.info(
+                "{tool} citations per call: "
+                + ("{fetched:.1f} fetched, " if fetched is not None else "")
+                + "{returned:.1f} returned",
+                tool=tool,
+                fetched=fetched,
+                returned=returned,
+                duplicate_rate=deps.duplicates.rate,
+            )
+
+    def stop_reason(self, e: TimeoutError | RunStopped) -> str:
+        if isinstance(e, TimeoutError):
+            return f"it took longer than {self.config.run_deadline:.0f} seconds"
+        return str(e)
+
+    def stopped_checked(self, deps: Deps, reason: str) -> CheckedResult:
+        """A checked result holding every fragment the tools found."""
+        return CheckedResult.from_stopped(self.query, reason, list(deps.found.values()))
+
+    def stopped_result(self, deps: Deps, reason: str) -> OngoingResult:
+        """A final result for a run that stopped early, with what we found."""
+        checked = self.stopped_checked(deps, reason)
+        final = "\n\n".join(
+            [
+                "# Research stopped",
+                f"The research stopped before it reached an answer, as {reason}.",
+                self.get_summary(),
+                checked.get_references_markdown(css_class="legal_ref"),
+            ]
+        )
+        return OngoingResult(
+            logging=f"### Research stopped\n\nThe research stopped, as {reason}.\n",
+            final=final,
+            complete=True,
+            stopped=reason,
+        )
+
+    def finish_run(self, deps: Deps, outcome: RunOutcome):
+        if outcome != RunOutcome.COMPLETED:
+            # Stop any graph query still running in its thread.
+            deps.kuzudb.interrupt()
+        if deps.prefetcher is not None:
+            deps.prefetcher.close()
+            stats = deps.prefetcher.stats
+            logfire.info(
+                "prefetch hit rate {hit_rate:.0%}, {wasted} wasted",
+                hit_rate=stats.hit_rate(),
+                **asdict(stats),
+            )
+        RUN_OUTCOMES[outcome] += 1
+        logfire.info(
+            "run {outcome}",
+            outcome=outcome,
+            outcomes={str(k): v for k, v in RUN_OUTCOMES.items()},
+        )
 
     def process_user_prompt(self, txt: str) -> str:
         """Process the user prompt to remove any extra text."""
@@ -211,7 +814,7 @@ class AgentRunner:
             f"### Beginning Research\n\nI'm considering the question: \n> **{txt}**\n"
         )
 
-    def process_one_tool(self, id: str, tool_name: str, args: dict[str, str]):
+    def process_one_tool(self, id: str, tool_name: str, args: dict[str, Any]):
         data = ToolCallData(id=id)
         md = data.md
         if tool_name == "get_legislation":
@@ -219,6 +822,21 @@ class AgentRunner:
             query = args.get("query", "")
             md.append("Looking for text related to:\n")
             md.append(f"> **{query}**")
+        elif tool_name == "get_fragments":
+            md.append("### Re-read fragments\n")
+            ids = ", ".join(args.get("reference_ids", []))
+            md.append(f"Fetching the full text of {ids}")
+            if args.get("with_context"):
+                md.append(", with the sections around them")
+        elif tool_name == "get_neighbourhood":
+            md.append("### Explored neighbourhood\n")
+            md.append("Looking for links and referrers around:\n")
+            for identifier in args.get("reference_ids", []):
+                cite = self.references.get(identifier)
+                if cite is None:
+                    md.append(f"The given link {identifier} appears invalid...")
+                else:
+                    md.append(cite.get_summary())
         else:
             identifier = args.get("reference_id", "")
             cite = self.references.get(identifier)
@@ -256,11 +874,20 @@ class AgentRunner:
         return "".join(markdown)
 
     def process_tool_return(self, request: ToolReturnPart) -> str:
-        if not isinstance(request.content, list):
-            raise ValueError("Tool return is not a list")
+        invalid = []
+        not_fetched = []
+        match request.content:
+            case FragmentsResult():
+                content = request.content.citations + request.content.context
+                invalid = request.content.invalid
+                not_fetched = request.content.not_fetched
+            case list():
+                content = request.content
+            case _:
+                raise ValueError("Tool return is not a list")
         titles = defaultdict(int)
 
-        for cite in request.content:
+        for cite in content:
             if not isinstance(cite, LLMCitation):
                 raise ValueError("Tool return is not a list of citations")
             # Keep a dict of references
@@ -270,73 +897,160 @@ class AgentRunner:
         data = self.tool_calls.pop(request.tool_call_id)
 
         md = data.md
-        cnt = len(request.content)
+        cnt = len(content)
         md.append(f"\n\n#### {cnt} References found\n")
         if len(titles) > 0:
             for title, count in titles.items():
                 md.append(f"- {title} ({count})\n")
         else:
             md.append("No references found!\n")
+        for identifier in invalid:
+            md.append(f"\nThe given link {identifier} appears invalid...\n")
+        if not_fetched:
+            md.append(f"\n{len(not_fetched)} more were past the limit.\n")
+        return "".join(md)
+
+    def process_retry(self, request: RetryPromptPart) -> str:
+        """A tool call that failed, and goes back to the model."""
+        md = []
+        if request.tool_call_id is not None:
+            data = self.tool_calls.pop(request.tool_call_id, None)
+            if data is not None:
+                md = data.md
+        md.append("\n\n#### That failed, so trying again\n")
+        if isinstance(request.content, str):
+            md.append(f"> {request.content}\n")
         return "".join(md)
 
-    def process_final_result(
+    async def check_result(
+        self, output: LLMResult | str, db: lancedb.DBConnection
+    ) -> CheckedResult:
+        """Check the citations in a thread, as each is a database lookup."""
+        return await asyncio.to_thread(
+            CheckedResult.from_llm_result, self.query, output, db
+        )
+
+    async def process_final_result(
         self,
         result: FinalResult[str] | FinalResult[LLMResult],
         db: lancedb.DBConnection,
     ) -> str:
         """Check all the references"""
-        checked = CheckedResult.from_llm_result(self.query, result.output, db)
+        checked = await self.check_result(result.output, db)
         return checked.to_markdown(css_refs="legal_ref")
 
+    async def run_checked(self) -> CheckedResult:
+        """Run the query without streaming, returning the checked result."""
+        agent = self.get_agent()
+        deps = await self.get_deps()
+        outcome = RunOutcome.ABANDONED
+        try:
+            try:
+                async with agent.iter(self.query, deps=deps) as agent_run:
+                    try:
+                        async with asyncio.timeout(self.config.run_deadline):
+                            async for _ in agent_run:
+                                pass
+                    finally:
+                        # Stopped runs count their turns too.
+                        self.log_stats(deps, agent_run.usage())
+                    result = agent_run.result
+                    assert result is not None
+            except (TimeoutError, RunStopped) as e:
+                outcome = RunOutcome.STOPPED
+                return self.stopped_checked(deps, self.stop_reason(e))
+
+            checked = await self.check_result(result.output, deps.lancedb)
+            outcome = RunOutcome.COMPLETED
+            return checked
+        except Exception:
+            outcome = RunOutcome.FAILED
+            raise
+        finally:
+            self.finish_run(deps, outcome)
+
+    def process_node(self, node: object) -> OngoingResult | None:
+        """Translate an intermediate node into progress, if it has any."""
+        match node:
+            case UserPromptNode(user_prompt=prompt):
+                if not isinstance(prompt, str):
+                    raise ValueError("Prompt is not a string")
+                # This is just the initial prompt...
+                return OngoingResult(
+                    logging=self.process_user_prompt(prompt),
+                    summary=self.get_summary(),
+                )
+            case ModelRequestNode(request=request):
+                # We only both looking at tool returns
+                for part in request.parts:
+                    if isinstance(part, ToolReturnPart):
+                        return OngoingResult(
+                            logging=self.process_tool_return(part),
+                            summary=self.get_summary(),
+                        )
+                    if isinstance(part, RetryPromptPart):
+                        return OngoingResult(
+                            logging=self.process_retry(part),
+                            summary=self.get_summary(),
+                        )
+            case CallToolsNode(model_response=model_response):
+                for part in model_response.parts:
+                    # only process it if we find an actual tool call
+                    if isinstance(part, ToolCallPart):
+                        # We only both looking at tool calls
+                        return OngoingResult(
+                            logging=self.process_tool_call(model_response),
+                            summary=self.get_summary(),
+                        )
+        return None
+
     async def run_query(self) -> AsyncIterator[OngoingResult]:
         """This is our main async generation.
 
         It returns Markdown text for each step of the process.
         We translate between the internal nodes to progress and final text.
+        Runs that pass the deadline or use too many tools stop early, and
+        return what they found so far.
         """
 
         agent = self.get_agent()
-        deps = self.get_deps()
-        async with agent.iter(self.query, deps=deps) as agent_run:
-            async for node in agent_run:
-                match node:
-                    case UserPromptNode(user_prompt=prompt):
-                        if not isinstance(prompt, str):
-                            raise ValueError("Prompt is not a string")
-                        # This is just the initial prompt...
-                        yield OngoingResult(
-                            logging=self.process_user_prompt(prompt),
-                            summary=self.get_summary(),
-                        )
-                    case ModelRequestNode(request=request):
-                        # We only both looking at tool returns
-                        for part in request.parts:
-                            if isinstance(part, ToolReturnPart):
-                                yield OngoingResult(
-                                    logging=self.process_tool_return(part),
-                                    summary=self.get_summary(),
-                                )
-                                break
-                    case CallToolsNode(model_response=model_response):
-                        for part in model_response.parts:
-                            # only process it if we find an actual tool call
-                            if isinstance(part, ToolCallPart):
-                                # We only both looking at tool calls
-                                yield OngoingResult(
-                                    logging=self.process_tool_call(model_response),
-                                    summary=self.get_summary(),
-                                )
-                                break
-                    case End(data=data):
-                        yield OngoingResult(
-                            final=self.process_final_result(data, deps.lancedb),
-                            complete=True,
-                        )
+        deps = await self.get_deps()
+        deadline = asyncio.get_running_loop().time() + self.config.run_deadline
+        outcome = RunOutcome.ABANDONED
+        try:
+            try:
+                async with agent.iter(self.query, deps=deps) as agent_run:
+                    node = agent_run.next_node
+                    try:
+                        while not isinstance(node, End):
+                            ongoing = self.process_node(node)
+                            if ongoing is not None:
+                                yield ongoing
+                            # Only our own awaits go inside the timeout, as a
+                            # timeout around a yield would fire in the consumer.
+                            async with asyncio.timeout_at(deadline):
+                                node = await agent_run.next(node)
+                    finally:
+                        self.log_stats(deps, agent_run.usage())
+
+                    final = await self.process_final_result(node.data, deps.lancedb)
+                    outcome = RunOutcome.COMPLETED
+                    yield OngoingResult(final=final, complete=True)
+                    return
+            except (TimeoutError, RunStopped) as e:
+                reason = self.stop_reason(e)
+            outcome = RunOutcome.STOPPED
+            yield self.stopped_result(deps, reason)
+        except Exception:
+            outcome = RunOutcome.FAILED
+            raise
+        finally:
+            self.finish_run(deps, outcome)
 
     async def run_query_dumb(self) -> AsyncIterator[object]:
         """This returns all the raw nodes. Just for testing."""
         agent = self.get_agent()
-        deps = self.get_deps()
+        deps = await self.get_deps()
         async with agent.iter(self.query, deps=deps) as agent_run:
             async for node in agent_run:
                 yield node
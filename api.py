@@ -0,0 +1,109 @@
+import json
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+
+import logfire
+from pydantic import BaseModel, ValidationError
+from sse_starlette import EventSourceResponse
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from agent import RUN_OUTCOMES, AgentRunner, DatabasePool
+from memory import report_budgets, start_memory_sampler
+from model import AgentType, Config
+
+logfire.configure()
+logfire.instrument_openai()
+logfire.instrument_anthropic()
+
+
+class QueryRequest(BaseModel):
+    query: str
+    agent_type: AgentType = AgentType.CLAUDE
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette) -> AsyncIterator[None]:
+    """Open the databases once per worker process."""
+    config = Config()  # type: ignore
+    app.state.config = config
+    report_budgets(config)
+    app.state.pool = DatabasePool.from_config(config)
+    start_memory_sampler(config.memory_sample_interval)
+    yield
+
+
+async def get_runner(request: Request) -> AgentRunner:
+    """Build a runner that uses the shared database pool."""
+    body = QueryRequest.model_validate(await request.json())
+    config = request.app.state.config.model_copy(update={"agent_type": body.agent_type})
+    return AgentRunner(body.query, config=config, pool=request.app.state.pool)
+
+
+async def stream_query(request: Request) -> Response:
+    """Stream each step of the research as server-sent events."""
+    try:
+        runner = await get_runner(request)
+    except (ValidationError, json.JSONDecodeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+
+    async def events() -> AsyncIterator[dict[str, str]]:
+        with logfire.span("API stream query", query=runner.query):
+            try:
+                async for ongoing in runner.run_query():
+                    yield {
+                        "event": "final" if ongoing.complete else "progress",
+                        "data": json.dumps(asdict(ongoing)),
+                    }
+            except Exception as e:
+                logfire.exception("API stream query failed")
+                yield {"event": "error", "data": json.dumps({"error": str(e)})}
+
+    return EventSourceResponse(events())
+
+
+async def checked_query(request: Request) -> Response:
+    """Run the research and return the CheckedResult as JSON."""
+    try:
+        runner = await get_runner(request)
+    except (ValidationError, json.JSONDecodeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+
+    with logfire.span("API checked query", query=runner.query):
+        checked = await runner.run_checked()
+    return JSONResponse(checked.model_dump())
+
+
+async def health(request: Request) -> Response:
+    outcomes = {str(k): v for k, v in RUN_OUTCOMES.items()}
+    return JSONResponse({"status": "ok", "runs": outcomes})
+
+
+app = Starlette(
+    routes=[
+        Route("/query/stream", stream_query, methods=["POST"]),
+        Route("/query", checked_query, methods=["POST"]),
+        Route("/health", health, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the research API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of worker processes"
+    )
+    args = parser.parse_args()
+
+    # Workers need an import string, so each process builds its own app.
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
@@ -9,6 +9,7 @@ import toml
 from pydantic_settings import BaseSettings
 
 from agent import AgentRunner
+from memory import report_budgets, start_memory_sampler
 from model import CONFIG_DICT, AgentType, Config
 
 logfire.configure()
@@ -45,6 +46,17 @@ def get_auth_config() -> AuthConfig:
     return AuthConfig()  # type: ignore
 
 
+@st.cache_resource
+def start_monitoring():
+    """Report the memory budgets and start sampling, once per server."""
+    cf = Config()  # type: ignore
+    report_budgets(cf)
+    start_memory_sampler(cf.memory_sample_interval)
+
+
+start_monitoring()
+
+
 TITLE = f"Public Act Search (v{VERSION})"
 st.set_page_config(
     page_title=TITLE,
@@ -98,6 +110,8 @@ if "logs" not in st.session_state:
     st.session_state.logs = []  # Store log messages
 if "result_markdown" not in st.session_state:
     st.session_state.result_markdown = ""
+if "stopped" not in st.session_state:
+    st.session_state.stopped = ""
 
 
 # Callback to handle form submission
@@ -114,6 +128,7 @@ def new_search():
     st.session_state.query_input = ""
     # Note: We don't clear logs here to keep them visible
     st.session_state.result_markdown = ""
+    st.session_state.stopped = ""
 
 
 # Create placeholders for main content components
@@ -181,12 +196,6 @@ elif st.session_state.processing and not st.session_state.results_ready:
                     # try to get next chunk
                     try:
                         ongoing = await async_iter.__anext__()
-                        if ongoing.complete:
-                            # set the result markdown
-                            ss.result_markdown = ongoing.final
-                            # empty the iterator
-                            while True:
-                                _ = await async_iter.__anext__()
 
                         # we got a new chunk, add it to logs
                         # timestamp = datetime.now().strftime("%h:%m:%s")
@@ -196,6 +205,14 @@ elif st.session_state.processing and not st.session_state.results_ready:
                         with log_container:
                             st.markdown(ongoing.logging, unsafe_allow_html=True)
 
+                        if ongoing.complete:
+                            # set the result markdown
+                            ss.result_markdown = ongoing.final
+                            ss.stopped = ongoing.stopped
+                            # empty the iterator
+                            while True:
+                                _ = await async_iter.__anext__()
+
                         with results_placeholder:
                             # display the markdown results
                             st.markdown(ongoing.summary, unsafe_allow_html=True)
@@ -209,6 +226,10 @@ elif st.session_state.processing and not st.session_state.results_ready:
 
             except Exception as e:
                 st.error(f"Error processing query: {e}")
+            finally:
+                # A rerun (e.g. "New Search") lands here too, so the agent run
+                # is closed and counted as abandoned rather than left running.
+                await async_iter.aclose()
 
         # run the async function in the main thread
         loop = asyncio.new_event_loop()
@@ -231,7 +252,12 @@ elif st.session_state.results_ready:
             st.markdown(log_text, unsafe_allow_html=True)
 
     # show results using pure streamlit elements
-    success_placeholder.success("Research Complete!")
+    if st.session_state.stopped:
+        success_placeholder.warning(
+            f"Research stopped early, as {st.session_state.stopped}."
+        )
+    else:
+        success_placeholder.success("Research Complete!")
     with results_placeholder:
         # display the markdown results
         st.markdown(st.session_state.result_markdown, unsafe_allow_html=True)
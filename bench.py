@@ -0,0 +1,221 @@
+"""Benchmarks for the research pipeline.
+
+These need the databases (and API keys for the agent runs), so they are
+run by hand rather than as tests.
+"""
+
+import asyncio
+import re
+import statistics
+import time
+from pathlib import Path
+
+import kuzu
+import numpy as np
+from rich import print
+
+from agent import CYPHER_LINKS, CYPHER_REFERRERS, AgentRunner, run_cypher
+from graph import CSRGraph
+from model import AgentType, Config
+from result import RE_REFERENCE, CheckedCitation, CheckedResult
+
+
+def read_queries(path: Path) -> list[str]:
+    """One benchmark query per line, ignoring blank lines."""
+    lines = path.read_text().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+async def model_turns(queries: list[str], config: Config) -> tuple[list[int], int]:
+    """Model turns for each run that completed, and the number that stopped.
+
+    Stopped runs are left out, as their turns reflect the limits.
+    """
+    turns = []
+    stopped = 0
+    for query in queries:
+        runner = AgentRunner(query, config=config)
+        checked = await runner.run_checked()
+        if checked.stopped:
+            stopped += 1
+        else:
+            turns.append(runner.model_turns)
+    return turns, stopped
+
+
+async def bench_turns(queries: list[str], agent_type: AgentType):
+    """Compare model turns per session with and without get_neighbourhood."""
+    results = {}
+    stopped = {}
+    for use_neighbourhood in (False, True):
+        config = Config(
+            agent_type=agent_type,
+            use_neighbourhood=use_neighbourhood,
+        )  # type: ignore
+        turns, n = await model_turns(queries, config)
+        results[use_neighbourhood], stopped[use_neighbourhood] = turns, n
+
+    print(f"Model turns per completed session over {len(queries)} queries")
+    if not results[False] or not results[True]:
+        print(f"- too many stopped: {stopped[False]} without, {stopped[True]} with")
+        return
+    before = statistics.mean(results[False])
+    after = statistics.mean(results[True])
+    print(f"- without get_neighbourhood: {before:.2f} ({stopped[False]} stopped)")
+    print(f"- with get_neighbourhood: {after:.2f} ({stopped[True]} stopped)")
+    print(f"- reduction: {before - after:.2f} ({(before - after) / before:.0%})")
+
+
+def bench_csr(samples: int, limit: int, path: Path | None):
+    """Check the CSR graph against run_cypher, and time both."""
+    cf = Config()  # type: ignore
+    conn = kuzu.Connection(kuzu.Database(cf.kuzu_path, read_only=True))
+    graph = CSRGraph.load(path) if path is not None else CSRGraph.from_kuzu(conn)
+
+    rng = np.random.default_rng(0)
+    names = list(graph.index)
+    picks = [names[i] for i in rng.choice(len(names), size=samples, replace=False)]
+    for title, cypher, method in [
+        ("links", CYPHER_LINKS, graph.links),
+        ("referrers", CYPHER_REFERRERS, graph.referrers),
+    ]:
+        kuzu_time = csr_time = 0.0
+        mismatches = []
+        for name in picks:
+            start = time.perf_counter()
+            expected = run_cypher(conn, cypher, name, limit)
+            kuzu_time += time.perf_counter() - start
+            start = time.perf_counter()
+            actual = method(name, limit)
+            csr_time += time.perf_counter() - start
+            if actual != expected:
+                mismatches.append(name)
+        print(f"## {title} ({samples} fragments, limit {limit})")
+        print(f"- kuzu: {kuzu_time * 1000 / samples:.2f} ms per call")
+        print(f"- csr: {csr_time * 1000 / samples:.2f} ms per call")
+        print(f"- mismatches: {len(mismatches)} {mismatches[:5]}")
+
+
+def sample_result(citations: int, mentions: int) -> CheckedResult:
+    """A large answer that cites each reference many times."""
+    refs = [f"ACT{i % 40}-{i}-{i % 7}" for i in range(citations)]
+    body = ["Some legal text that goes on for a while."] * 20
+    cites = [
+        CheckedCitation(
+            reference=ref, text="\n".join([f"# Act {ref}", "## Part 1", *body])
+        )
+        for ref in refs
+    ]
+    paragraphs = []
+    for i in range(mentions):
+        ref = refs[i % citations]
+        # The model writes some references in brackets already.
+        cited = f"[{ref}]" if i % 3 == 0 else ref
+        paragraphs.append(f"As set out in {cited}, the duty applies.")
+    return CheckedResult(
+        query="query",
+        question="question",
+        response="\n\n".join(paragraphs),
+        errors=[],
+        citations=cites,
+        was_structured=True,
+    )
+
+
+def format_links_before(text: str) -> str:
+    """format_links as it was, rebuilding the text once per reference."""
+
+    def transform_anchor(text: str) -> str:
+        text = re.sub(r"[\u2013\u2014\u2212\u2012\u2010\u2043]", "-", text)
+        text = text.lower()
+        return re.sub(r"^([a-z]+)(\d+)", r"\1-\2", text)
+
+    replacements = []
+    for match in RE_REFERENCE.finditer(text):
+        start, end = match.span()
+        ref = match.group()
+        link = f"[{ref}](#{transform_anchor(ref)})"
+        if text[start - 1 : start] == "[" and text[end : end + 1] == "]":
+            replacements.append((start - 1, end + 1, link))
+        else:
+            replacements.append((start, end, link))
+    replacements.sort(key=lambda x: x[0], reverse=True)
+    for start, end, link in replacements:
+        text = text[:start] + link + text[end:]
+    return text
+
+
+def timed(fn, repeat: int) -> float:
+    """Milliseconds per call."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_markdown(citations: int, mentions: int, reruns: int):
+    """Time linking and rendering a large, citation heavy result."""
+    sample = sample_result(citations, mentions)
+    raw = sample.response
+    expected = format_links_before(raw)
+
+    def link_after():
+        sample.response = raw
+        sample.format_links()
+
+    before = timed(lambda: format_links_before(raw), 5)
+    after = timed(link_after, 5)
+    assert sample.response == expected, "single pass linking changed the output"
+
+    # The page renders the result for the pane and the download, on each rerun.
+    def render_uncached():
+        fresh = CheckedResult.model_validate(sample.model_dump())
+        return fresh.to_markdown(css_refs="legal_ref")
+
+    uncached = timed(render_uncached, 5)
+    start = time.perf_counter()
+    for _ in range(reruns):
+        sample.to_markdown(css_refs="legal_ref")
+    cached = (time.perf_counter() - start) * 1000
+
+    print(f"Markdown for {citations} citations and {mentions} mentions")
+    print(f"- format_links before: {before:.2f} ms")
+    print(f"- format_links after: {after:.2f} ms ({before / after:.0f}x)")
+    print(f"- first render: {uncached:.2f} ms")
+    print(f"- {reruns} cached renders: {cached:.2f} ms")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the research pipeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    turns = sub.add_parser("turns", help="model turns with and without neighbourhoods")
+    turns.add_argument("queries", type=Path, help="a file of queries, one per line")
+    turns.add_argument(
+        "--agent",
+        type=AgentType,
+        choices=list(AgentType),
+        default=AgentType.CLAUDE,
+        help="The agent to use (optional)",
+    )
+
+    csr = sub.add_parser("csr", help="compare the CSR graph with kuzu")
+    csr.add_argument("--path", type=Path, help="a built graph (else export)")
+    csr.add_argument("--samples", type=int, default=200)
+    csr.add_argument("--limit", type=int, default=20)
+
+    md = sub.add_parser("markdown", help="linking and rendering a large result")
+    md.add_argument("--citations", type=int, default=200)
+    md.add_argument("--mentions", type=int, default=2000)
+    md.add_argument("--reruns", type=int, default=100)
+    args = parser.parse_args()
+
+    match args.command:
+        case "turns":
+            asyncio.run(bench_turns(read_queries(args.queries), args.agent))
+        case "csr":
+            bench_csr(args.samples, args.limit, args.path)
+        case "markdown":
+            bench_markdown(args.citations, args.mentions, args.reruns)
@@ -0,0 +1,315 @@
+"""An in-memory CSR copy of the kuzu graph, for link traversal.
+
+The graph is small and read-only, so it is exported once into array-backed
+adjacency (NumPy int32 offsets and targets), optionally saved as a directory
+of `.npy` files that are memory-mapped on load. It answers the same
+questions as CYPHER_LINKS and CYPHER_REFERRERS in agent.py.
+
+Note that those queries use unlabelled relationship variables (`[Refers_to]`
+and `[Child_of*]` name variables, not tables), so they follow any edge. We
+do the same, and count walks the same way kuzu does, so that the ranking
+(by path count, then name) and hence the limits agree.
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Self
+
+import kuzu
+import numpy as np
+import pyarrow as pa
+
+from model import LLMCitation
+
+# Node kinds
+OTHER, FRAGMENT, SECTION = 0, 1, 2
+# Kuzu's default upper bound for a variable length relationship (`*`).
+MAX_HOPS = 30
+ARRAYS = [
+    "kind",
+    "act",
+    "name_rank",
+    "phrase_rank",
+    "group",
+    "out_offsets",
+    "out_targets",
+    "in_offsets",
+    "in_targets",
+    "name_offsets",
+    "name_bytes",
+    "phrase_offsets",
+    "phrase_bytes",
+]
+
+
+def csr(src: np.ndarray, dst: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """Offsets and targets of the edges src -> dst, grouped by src."""
+    order = np.argsort(src, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+    return offsets, dst[order].astype(np.int32)
+
+
+def pack(texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Pack strings into one utf-8 buffer, with offsets."""
+    encoded = [t.encode() for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def node_keys(ids: pa.ChunkedArray) -> np.ndarray:
+    """Kuzu internal ids ({table, offset}) as single int64 keys."""
+    ids = ids.combine_chunks()
+    table = ids.field("table").to_numpy().astype(np.int64)
+    offset = ids.field("offset").to_numpy().astype(np.int64)
+    return (table << 40) | offset
+
+
+def query_arrow(conn: kuzu.Connection, cypher: str) -> pa.Table:
+    results = conn.execute(cypher)
+    assert not isinstance(results, list)
+    return results.get_as_arrow()
+
+
+def gather(
+    offsets: np.ndarray, targets: np.ndarray, nodes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Every edge out of the nodes, in one go.
+
+    Returns the targets, and the number of edges out of each node.
+    """
+    starts = offsets[nodes].astype(np.int64)
+    lens = offsets[nodes + 1] - starts
+    first = np.repeat(np.cumsum(lens) - lens, lens)
+    pos = np.arange(int(lens.sum())) - first + np.repeat(starts, lens)
+    return np.asarray(targets[pos]), lens
+
+
+def walk(
+    offsets: np.ndarray, targets: np.ndarray, start: np.ndarray, counts: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Count walks of 1 to MAX_HOPS edges from the start nodes.
+
+    Returns the nodes reached, and the number of walks reaching each.
+    """
+    reached = []
+    reached_counts = []
+    frontier, frontier_counts = start, counts
+    for _ in range(MAX_HOPS):
+        nodes, lens = gather(offsets, targets, frontier)
+        if len(nodes) == 0:
+            break
+        weights = np.repeat(frontier_counts, lens)
+        frontier, inverse = np.unique(nodes, return_inverse=True)
+        frontier_counts = np.bincount(inverse, weights=weights).astype(np.int64)
+        reached.append(frontier)
+        reached_counts.append(frontier_counts)
+    if not reached:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+    return aggregate(np.concatenate(reached), np.concatenate(reached_counts))
+
+
+def aggregate(nodes: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    unique, inverse = np.unique(nodes, return_inverse=True)
+    return unique, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+@dataclass(kw_only=True)
+class CSRGraph:
+    kind: np.ndarray
+    # Interned act (the name up to the first "-") of each fragment, else -1.
+    act: np.ndarray
+    # Position of each fragment name among the sorted distinct names, so
+    # fragments with the same name have the same rank.
+    name_rank: np.ndarray
+    # Likewise for phrases, the last tie break.
+    phrase_rank: np.ndarray
+    # The first fragment with the same name and phrase, as kuzu groups
+    # results by both.
+    group: np.ndarray
+    out_offsets: np.ndarray
+    out_targets: np.ndarray
+    in_offsets: np.ndarray
+    in_targets: np.ndarray
+    name_offsets: np.ndarray
+    name_bytes: np.ndarray
+    phrase_offsets: np.ndarray
+    phrase_bytes: np.ndarray
+
+    def __post_init__(self):
+        # Names need not be unique, so each maps to all of its fragments.
+        index: dict[str, list[int]] = {}
+        for node in np.flatnonzero(self.kind == FRAGMENT):
+            index.setdefault(self.name(node), []).append(node)
+        self.index = {
+            name: np.array(nodes, dtype=np.int32) for name, nodes in index.items()
+        }
+
+    @classmethod
+    def from_kuzu(cls, conn: kuzu.Connection) -> Self:
+        """Export the whole graph from kuzu."""
+        nodes = query_arrow(conn, "MATCH (n) RETURN id(n) AS id, label(n) AS label")
+        keys = node_keys(nodes["id"])
+        sorter = np.argsort(keys)
+
+        def intern(ids: pa.ChunkedArray) -> np.ndarray:
+            return sorter[np.searchsorted(keys, node_keys(ids), sorter=sorter)]
+
+        n = len(keys)
+        labels = nodes["label"].to_numpy(zero_copy_only=False)
+        kind = np.full(n, OTHER, dtype=np.int8)
+        kind[labels == "Fragment"] = FRAGMENT
+        kind[labels == "Section"] = SECTION
+
+        frags = query_arrow(
+            conn,
+            "MATCH (f:Fragment) RETURN id(f) AS id, f.name AS name, f.phrase AS phrase",
+        )
+        frag_nodes = intern(frags["id"])
+        names = [""] * n
+        phrases = [""] * n
+        for node, name, phrase in zip(
+            frag_nodes,
+            frags["name"].to_pylist(),
+            frags["phrase"].to_pylist(),
+            strict=True,
+        ):
+            names[node] = name
+            phrases[node] = phrase or ""
+
+        acts: dict[str, int] = {}
+        ranks = {name: rank for rank, name in enumerate(sorted(set(names)))}
+        phrase_ranks = {p: rank for rank, p in enumerate(sorted(set(phrases)))}
+        groups: dict[tuple[str, str], int] = {}
+        act = np.full(n, -1, dtype=np.int32)
+        name_rank = np.full(n, -1, dtype=np.int32)
+        phrase_rank = np.full(n, -1, dtype=np.int32)
+        group = np.full(n, -1, dtype=np.int32)
+        for node in sorted(frag_nodes):
+            name = names[node]
+            name_rank[node] = ranks[name]
+            phrase_rank[node] = phrase_ranks[phrases[node]]
+            group[node] = groups.setdefault((name, phrases[node]), node)
+            act[node] = acts.setdefault(name.split("-")[0], len(acts))
+
+        edges = query_arrow(conn, "MATCH (a)-[e]->(b) RETURN id(a) AS a, id(b) AS b")
+        src, dst = intern(edges["a"]), intern(edges["b"])
+        out_offsets, out_targets = csr(src, dst, n)
+        in_offsets, in_targets = csr(dst, src, n)
+        name_offsets, name_bytes = pack(names)
+        phrase_offsets, phrase_bytes = pack(phrases)
+        return cls(
+            kind=kind,
+            act=act,
+            name_rank=name_rank,
+            phrase_rank=phrase_rank,
+            group=group,
+            out_offsets=out_offsets,
+            out_targets=out_targets,
+            in_offsets=in_offsets,
+            in_targets=in_targets,
+            name_offsets=name_offsets,
+            name_bytes=name_bytes,
+            phrase_offsets=phrase_offsets,
+            phrase_bytes=phrase_bytes,
+        )
+
+    def save(self, path: Path):
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(path / f"{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, path: Path) -> Self:
+        """Load a saved graph, memory-mapping the arrays."""
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        return cls(**arrays)
+
+    def name(self, node: int) -> str:
+        start, end = self.name_offsets[node], self.name_offsets[node + 1]
+        return self.name_bytes[start:end].tobytes().decode()
+
+    def phrase(self, node: int) -> str:
+        start, end = self.phrase_offsets[node], self.phrase_offsets[node + 1]
+        return self.phrase_bytes[start:end].tobytes().decode()
+
+    def ranked(
+        self, nodes: np.ndarray, counts: np.ndarray, limit: int
+    ) -> list[LLMCitation]:
+        """The top fragments, by walk count, name and phrase (as in the Cypher).
+
+        Like kuzu, we count by name and phrase and limit, and then like
+        run_cypher, keep the first of any repeated name.
+        """
+        nodes, counts = aggregate(self.group[nodes], counts)
+        keys = (self.phrase_rank[nodes], self.name_rank[nodes], -counts)
+        order = np.lexsort(keys)[:limit]
+        citations = []
+        seen = set()
+        for node in nodes[order]:
+            if self.name_rank[node] not in seen:
+                seen.add(self.name_rank[node])
+                citations.append(
+                    LLMCitation(reference=self.name(node), text=self.phrase(node))
+                )
+        return citations
+
+    def count_names(self, nodes: np.ndarray) -> int:
+        """How many distinct fragment names the nodes have."""
+        return len(np.unique(self.name_rank[nodes]))
+
+    def link_counts(self, reference_id: str) -> tuple[np.ndarray, np.ndarray]:
+        """As CYPHER_LINKS: fragments under the sections this one refers to,
+        with their walk counts, before ranking."""
+        start = self.index.get(reference_id)
+        if start is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+        nbrs, _ = gather(self.out_offsets, self.out_targets, start)
+        # Sections these fragments have edges to, counting repeated edges.
+        nbrs = nbrs[self.kind[nbrs] == SECTION]
+        sections, counts = aggregate(nbrs, np.ones(len(nbrs), dtype=np.int64))
+        nodes, counts = walk(self.in_offsets, self.in_targets, sections, counts)
+        keep = (self.kind[nodes] == FRAGMENT) & (
+            self.name_rank[nodes] != self.name_rank[start[0]]
+        )
+        return nodes[keep], counts[keep]
+
+    def referrer_counts(self, reference_id: str) -> tuple[np.ndarray, np.ndarray]:
+        """As CYPHER_REFERRERS: fragments in other acts that refer to sections
+        containing this one, with their walk counts, before ranking."""
+        start = self.index.get(reference_id)
+        if start is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+        ones = np.ones(len(start), dtype=np.int64)
+        reached, counts = walk(self.out_offsets, self.out_targets, start, ones)
+        is_section = self.kind[reached] == SECTION
+        sections, counts = reached[is_section], counts[is_section]
+
+        # Fragments with an edge into each section, weighted by its walks.
+        frags, lens = gather(self.in_offsets, self.in_targets, sections)
+        weights = np.repeat(counts, lens)
+        keep = (self.kind[frags] == FRAGMENT) & (self.act[frags] != self.act[start[0]])
+        return aggregate(frags[keep], weights[keep])
+
+    def links(self, reference_id: str, limit: int) -> list[LLMCitation]:
+        return self.ranked(*self.link_counts(reference_id), limit)
+
+    def referrers(self, reference_id: str, limit: int) -> list[LLMCitation]:
+        return self.ranked(*self.referrer_counts(reference_id), limit)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from model import Config
+
+    parser = argparse.ArgumentParser(
+        description="Export the kuzu graph to a CSR graph directory"
+    )
+    parser.add_argument("path", type=Path)
+    args = parser.parse_args()
+
+    cf = Config()  # type: ignore
+    conn = kuzu.Connection(kuzu.Database(cf.kuzu_path, read_only=True))
+    CSRGraph.from_kuzu(conn).save(args.path)
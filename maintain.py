@@ -0,0 +1,324 @@
+"""Maintenance for the lance `phrases` table.
+
+Optionally collapses duplicate rows, then compacts small fragments, prunes
+old versions, and refreshes the indexes, reporting table statistics before
+and after. Run it against a snapshot copy (see `--copy-to`) and promote the
+copy once the report looks right.
+"""
+
+import hashlib
+import json
+import shutil
+import time
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass, field
+from datetime import timedelta
+from pathlib import Path
+
+import lancedb
+import pyarrow as pa
+from rich import print
+from rich.table import Table
+
+# Fixed probes, so that latencies are comparable between runs.
+PROBE_QUERIES = [
+    "obligations of an employer to provide a safe workplace",
+    "who may apply for a protection order",
+    "powers of entry and search without a warrant",
+    "definition of a resource consent",
+]
+PROBE_ID_COUNT = 20
+DEDUP_REPORT = "phrases_dedup.json"
+EXAMPLE_COUNT = 20
+
+
+@dataclass(frozen=True, kw_only=True)
+class TableReport:
+    version: int
+    versions: int
+    rows: int
+    fragments: int
+    small_fragments: int
+    total_bytes: int
+    indices: int
+    search_ms: float
+    lookup_ms: float
+
+
+def sample_ids(table: lancedb.table.Table, n: int) -> list[str]:
+    """Pick some ids to probe the `id = ...` lookups with."""
+    rows = table.search().select(["id"]).limit(n).to_list()
+    return [row["id"] for row in rows]
+
+
+@dataclass(frozen=True, kw_only=True)
+class Probes:
+    ids: list[str]
+    # The probe queries, embedded once so that only the search is timed.
+    vectors: list[list[float]]
+    vector_column: str
+
+
+def make_probes(table: lancedb.table.Table) -> Probes:
+    functions = list(table.embedding_functions.values())
+    if not functions:
+        raise ValueError("the phrases table has no embedding function")
+    conf = functions[0]
+    return Probes(
+        ids=sample_ids(table, PROBE_ID_COUNT),
+        vectors=[
+            conf.function.compute_query_embeddings(query)[0] for query in PROBE_QUERIES
+        ],
+        vector_column=conf.vector_column,
+    )
+
+
+def probe(table: lancedb.table.Table, probes: Probes) -> tuple[float, float]:
+    """Mean latency (ms) of vector searches and id lookups.
+
+    These mirror get_legislation and build_checked_citations.
+    """
+    start = time.perf_counter()
+    for vector in probes.vectors:
+        query = table.search(vector, vector_column_name=probes.vector_column)
+        query.limit(20).to_list()
+    search_ms = (time.perf_counter() - start) * 1000 / len(probes.vectors)
+
+    start = time.perf_counter()
+    for ident in probes.ids:
+        table.search().where(f"id = '{ident}'").limit(1).to_list()
+    lookup_ms = (time.perf_counter() - start) * 1000 / max(len(probes.ids), 1)
+    return search_ms, lookup_ms
+
+
+def report(table: lancedb.table.Table, probes: Probes) -> TableReport:
+    stats = table.stats()
+    frags = stats["fragment_stats"]
+    search_ms, lookup_ms = probe(table, probes)
+    return TableReport(
+        version=table.version,
+        versions=len(table.list_versions()),
+        rows=stats["num_rows"],
+        fragments=frags["num_fragments"],
+        small_fragments=frags["num_small_fragments"],
+        total_bytes=stats["total_bytes"],
+        indices=stats["num_indices"],
+        search_ms=search_ms,
+        lookup_ms=lookup_ms,
+    )
+
+
+def print_reports(before: TableReport, after: TableReport):
+    table = Table(title="phrases table")
+    table.add_column("statistic")
+    table.add_column("before", justify="right")
+    table.add_column("after", justify="right")
+    for name in TableReport.__dataclass_fields__:
+        b, a = getattr(before, name), getattr(after, name)
+        fmt = "{:.2f}" if isinstance(b, float) else "{:,}"
+        table.add_row(name, fmt.format(b), fmt.format(a))
+    print(table)
+
+
+@dataclass(kw_only=True)
+class DedupReport:
+    rows_before: int = 0
+    rows_after: int = 0
+    # Rows that repeat an id we have already seen.
+    duplicate_id_rows: int = 0
+    # Ids whose text exactly matches an earlier id, now kept as aliases.
+    duplicate_text_ids: int = 0
+    examples: list[tuple[str, str]] = field(default_factory=list)
+
+
+def scan(table: lancedb.table.Table, columns: list[str]) -> Iterator[pa.RecordBatch]:
+    """Scan every row of the table, with its `_rowid`."""
+    query = table.search().select(columns).with_row_id(True).limit(None)
+    yield from query.to_batches()
+
+
+def find_duplicates(
+    table: lancedb.table.Table,
+) -> tuple[dict[int, list[str]], DedupReport]:
+    """Map the row id of each row we keep to its aliases.
+
+    The first row for an id, or for an exact text, is the canonical one.
+    Aliases from an earlier run are carried over.
+    """
+    has_aliases = "aliases" in table.schema.names
+    columns = ["id", "text", "aliases"] if has_aliases else ["id", "text"]
+    keep: dict[int, list[str]] = {}
+    by_id: dict[str, int] = {}
+    # Keyed on a digest, so we do not hold every text in memory.
+    by_text: dict[bytes, int] = {}
+    canonical_ids: dict[int, str] = {}
+    rep = DedupReport()
+    for batch in scan(table, columns):
+        data = batch.to_pydict()
+        old_aliases = data.get("aliases", [None] * batch.num_rows)
+        rows = zip(data["_rowid"], data["id"], data["text"], old_aliases, strict=True)
+        for row, ident, text, old in rows:
+            rep.rows_before += 1
+            carried = old or []
+            digest = hashlib.blake2b((text or "").encode(), digest_size=16).digest()
+            if ident in by_id:
+                rep.duplicate_id_rows += 1
+                keep[by_id[ident]].extend(carried)
+            elif digest in by_text:
+                canonical = by_text[digest]
+                rep.duplicate_text_ids += 1
+                if len(rep.examples) < EXAMPLE_COUNT:
+                    rep.examples.append((ident, canonical_ids[canonical]))
+                keep[canonical].extend([ident, *carried])
+                by_id[ident] = canonical
+            else:
+                keep[row] = list(carried)
+                by_id[ident] = row
+                by_text[digest] = row
+                canonical_ids[row] = ident
+    rep.rows_after = len(keep)
+    return keep, rep
+
+
+def dedup_phrases(db: lancedb.DBConnection, lance_path: Path) -> DedupReport:
+    """Rewrite the phrases table with one row per id and per exact text.
+
+    Collapsed ids go in an `aliases` list column. The rewrite streams from
+    a pinned version, which lance keeps readable while we overwrite it.
+    """
+    source = db.open_table("phrases")
+    source.checkout(source.version)
+    keep, rep = find_duplicates(source)
+
+    base = source.schema
+    if "aliases" in base.names:
+        base = base.remove(base.get_field_index("aliases"))
+    alias_type = pa.list_(pa.string())
+    schema = base.append(pa.field("aliases", alias_type))
+    # Keep the embedding function config, so text searches still work.
+    schema = schema.with_metadata(source.schema.metadata or {})
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        for batch in scan(source, base.names):
+            rowids = batch["_rowid"].to_pylist()
+            idx = [i for i, row in enumerate(rowids) if row in keep]
+            aliases = [sorted(set(keep[rowids[i]])) for i in idx]
+            kept = batch.take(pa.array(idx, type=pa.int64()))
+            columns = [kept[name] for name in base.names]
+            yield pa.RecordBatch.from_arrays(
+                [*columns, pa.array(aliases, type=alias_type)], schema=schema
+            )
+
+    db.create_table("phrases", data=batches(), schema=schema, mode="overwrite")
+    (lance_path / DEDUP_REPORT).write_text(json.dumps(asdict(rep), indent=2))
+    return rep
+
+
+def vector_metric(table: lancedb.table.Table, column: str) -> str | None:
+    """The distance metric of the existing index on column, if there is one."""
+    for index in table.list_indices():
+        if column in index.columns:
+            stats = table.index_stats(index.name)
+            if stats is not None:
+                return stats.distance_type
+    return None
+
+
+def maintain(
+    lance_path: Path,
+    keep_versions_for: timedelta,
+    rebuild_vector_index: bool,
+    metric: str | None,
+    dedup: bool,
+):
+    db = lancedb.connect(lance_path)
+    table = db.open_table("phrases")
+    probes = make_probes(table)
+    before = report(table, probes)
+    # A rebuild keeps the metric, as DISTANCE_CUTOFF and DISTANCE_GAP are
+    # tuned on its distances. Lance itself defaults to l2.
+    metric = metric or vector_metric(table, probes.vector_column) or "l2"
+
+    if dedup:
+        print("Collapsing duplicate rows...")
+        rep = dedup_phrases(db, lance_path)
+        print(rep)
+        table = db.open_table("phrases")
+        # The rewrite drops the indexes.
+        rebuild_vector_index = True
+
+    # Most lookups are `id = ...` filters, so keep a btree on id.
+    print("Rebuilding scalar index on id...")
+    table.create_scalar_index("id", replace=True)
+    if "aliases" in table.schema.names:
+        table.create_scalar_index("aliases", index_type="LABEL_LIST", replace=True)
+    if rebuild_vector_index:
+        print(f"Rebuilding vector index ({metric})...")
+        table.create_index(
+            metric=metric, vector_column_name=probes.vector_column, replace=True
+        )
+
+    # Compacts files, prunes old versions and brings indexes up to date.
+    print("Optimizing...")
+    table.optimize(cleanup_older_than=keep_versions_for)
+
+    after = report(table, probes)
+    print_reports(before, after)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from model import Config
+
+    parser = argparse.ArgumentParser(description="Maintain the lance phrases table")
+    parser.add_argument(
+        "--lance-path",
+        type=Path,
+        default=None,
+        help="the lance database (defaults to LANCE_PATH)",
+    )
+    parser.add_argument(
+        "--copy-to",
+        type=Path,
+        default=None,
+        help="copy the database here first, and maintain the copy",
+    )
+    parser.add_argument(
+        "--keep-days",
+        type=float,
+        default=0,
+        help="keep versions newer than this many days",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="collapse duplicate ids and texts into one row with aliases",
+    )
+    parser.add_argument(
+        "--rebuild-vector-index",
+        action="store_true",
+        help="rebuild the vector index from scratch (slow)",
+    )
+    parser.add_argument(
+        "--metric",
+        default=None,
+        help="metric for a rebuilt vector index (defaults to the current one)",
+    )
+    args = parser.parse_args()
+
+    lance_path = args.lance_path or Config().lance_path  # type: ignore
+    if args.copy_to is not None:
+        if args.copy_to.exists():
+            parser.error(f"{args.copy_to} already exists")
+        print(f"Copying {lance_path} to {args.copy_to}...")
+        shutil.copytree(lance_path, args.copy_to)
+        lance_path = args.copy_to
+
+    maintain(
+        lance_path,
+        keep_versions_for=timedelta(days=args.keep_days),
+        rebuild_vector_index=args.rebuild_vector_index,
+        metric=args.metric,
+        dedup=args.dedup,
+    )
@@ -0,0 +1,105 @@
+"""Memory budgets for the databases, and sampling of process memory.
+
+The fly VM is small, so the kuzu buffer pool and the lance index cache are
+sized explicitly (see `Config`), rather than left to their defaults.
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import logfire
+
+from model import Config
+
+MIB = 1024 * 1024
+
+# What a zero budget means. Kuzu takes 80% of physical memory for its buffer
+# pool and a thread per CPU; lance caches 256 index and 256 metadata entries
+# per table, and lancedb has no setting for the metadata cache.
+KUZU_BUFFER_POOL_SHARE = 0.8
+LANCE_CACHE_ENTRIES = 256
+
+
+def describe_bytes(n: int) -> str:
+    return f"{n / MIB:.0f} MiB" if n > 0 else "default"
+
+
+def physical_memory() -> int:
+    """Physical memory in bytes, as kuzu sees it (0 if we cannot tell)."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return 0
+
+
+def report_budgets(cf: Config):
+    """Log the effective memory budgets the databases are opened with.
+
+    Call this once at startup, not each time the databases are opened.
+    """
+    buffer_pool = cf.kuzu_buffer_pool_size or int(
+        physical_memory() * KUZU_BUFFER_POOL_SHARE
+    )
+    logfire.info(
+        "database budgets: kuzu buffer pool {kuzu_buffer_pool}, "
+        "{kuzu_threads} threads, lance index cache {lance_index_cache} entries, "
+        "lance metadata cache {lance_metadata_cache} entries",
+        kuzu_buffer_pool=describe_bytes(buffer_pool),
+        kuzu_buffer_pool_bytes=buffer_pool,
+        kuzu_threads=cf.kuzu_max_threads or os.cpu_count(),
+        kuzu_read_only=cf.kuzu_read_only,
+        lance_index_cache=cf.lance_index_cache_entries or LANCE_CACHE_ENTRIES,
+        lance_metadata_cache=LANCE_CACHE_ENTRIES,
+        defaults=[
+            name
+            for name, value in [
+                ("kuzu_buffer_pool_size", cf.kuzu_buffer_pool_size),
+                ("kuzu_max_threads", cf.kuzu_max_threads),
+                ("lance_index_cache_entries", cf.lance_index_cache_entries),
+            ]
+            if not value
+        ],
+    )
+
+
+def rss_bytes() -> int:
+    """The resident set size of this process (0 if we cannot tell)."""
+    try:
+        status = Path("/proc/self/status").read_text()
+    except OSError:
+        return 0
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            # Reported in kB.
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def sample_memory():
+    rss = rss_bytes()
+    logfire.info(
+        "memory: rss {rss}",
+        rss=describe_bytes(rss),
+        rss_bytes=rss,
+        python_blocks=sys.getallocatedblocks(),
+    )
+
+
+@functools.cache
+def start_memory_sampler(interval: float) -> threading.Thread | None:
+    """Sample process memory every interval seconds (once per process)."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            sample_memory()
+
+    sampler = threading.Thread(target=run, name="memory-sampler", daemon=True)
+    sampler.start()
+    return sampler
@@ -23,6 +23,12 @@ class AgentType(StrEnum):
     CLAUDE = auto()
 
 
+class GraphBackend(StrEnum):
+    KUZU = auto()
+    # An in-memory CSR copy of the graph (see graph.py).
+    CSR = auto()
+
+
 class Config(BaseSettings):
     """Query an LLM at the Command Line."""
 
@@ -31,6 +37,40 @@ class Config(BaseSettings):
     kuzu_path: Path
     # agent_type: AgentType = AgentType.CLAUDE
     agent_type: AgentType = AgentType.GPT
+    # Result limits for the semantic and graph tools.
+    phrase_limit: int = 20
+    link_limit: int = 20
+    neighbourhood_limit: int = 40
+    # Offer the multi-hop get_neighbourhood tool to the agent.
+    use_neighbourhood: bool = True
+    # Runs stop early (with what they found) past these limits.
+    run_deadline: float = 300
+    max_tool_calls: int = 20
+    # Milliseconds before a kuzu query is interrupted.
+    kuzu_query_timeout: int = 30_000
+    # Prefetch links and referrers for the top N semantic results (0 disables).
+    prefetch_top_n: int = 0
+    # Seconds a prefetched result stays usable.
+    prefetch_ttl: float = 120
+    # Where get_linked and get_referrers run, and a prebuilt CSR graph to
+    # memory-map (else it is exported from kuzu at startup).
+    graph_backend: GraphBackend = GraphBackend.KUZU
+    csr_path: Path | None = None
+    # Count every match of get_linked and get_referrers in kuzu, so the tool
+    # stats show what the link limit cut. It is a second query per call.
+    count_graph_matches: bool = False
+    # Memory budgets: the kuzu buffer pool in bytes, kuzu threads, and the
+    # lance index cache in entries (lancedb sizes it by count, not bytes).
+    # 0 uses the library default.
+    kuzu_buffer_pool_size: int = 0
+    kuzu_max_threads: int = 0
+    kuzu_read_only: bool = True
+    lance_index_cache_entries: int = 0
+    # Seconds between samples of process memory (0 disables).
+    memory_sample_interval: float = 60
+    # Relevance truncation for semantic search (None disables).
+    distance_cutoff: float | None = None
+    distance_gap: float | None = None
 
 
 # These are for the LLM agent. ---
@@ -67,6 +107,23 @@ class LLMCitation(BaseModel):
         return f"{heads}\n\n{texts}"
 
 
+class FragmentsResult(BaseModel):
+    citations: list[LLMCitation] = Field(
+        ..., description="The text of each reference id that was found"
+    )
+    context: list[LLMCitation] = Field(
+        default_factory=list,
+        description="Other text from the sections these fragments belong to",
+    )
+    invalid: list[str] = Field(
+        default_factory=list, description="Reference ids that could not be found"
+    )
+    not_fetched: list[str] = Field(
+        default_factory=list,
+        description="Reference ids past the limit for one call, ask for them again",
+    )
+
+
 # We use this for structured returns
 class LLMResult(BaseModel):
     question: str = Field(
@@ -0,0 +1,144 @@
+"""Speculative prefetch of graph traversals.
+
+After a semantic search, the model usually follows links or referrers of
+some of the returned fragments. The prefetcher starts those traversals in
+the background, one at a time on a connection of its own, so a later tool
+call for the same fragment can be served from a short-lived store. A
+traversal only starts while no tool query is running, so prefetching uses
+idle time rather than competing with the model's own calls.
+"""
+
+import asyncio
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+import kuzu
+import logfire
+
+from model import LLMCitation
+
+# Runs one traversal (e.g. links) for a reference id.
+type Traversal = Callable[[kuzu.Connection, str], list[LLMCitation]]
+type Key = tuple[str, str]
+
+
+@dataclass
+class PrefetchStats:
+    scheduled: int = 0
+    completed: int = 0
+    # Tool calls served by the prefetcher, or not.
+    hits: int = 0
+    misses: int = 0
+    # Completed traversals that no tool call used.
+    wasted: int = 0
+
+    def hit_rate(self) -> float:
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+
+@dataclass(kw_only=True)
+class Prefetcher:
+    kuzudb: kuzu.Connection
+    traversals: dict[str, Traversal]
+    top_n: int = 3
+    # Seconds a prefetched result stays usable.
+    ttl: float = 120
+    stats: PrefetchStats = field(default_factory=PrefetchStats)
+    store: dict[Key, tuple[float, asyncio.Future[list[LLMCitation] | None]]] = field(
+        default_factory=dict
+    )
+    queue: asyncio.Queue[Key] = field(default_factory=asyncio.Queue)
+    # Held by tool calls while they query kuzu.
+    tool_lock: asyncio.Lock | None = None
+    running: Key | None = None
+    worker: asyncio.Task[None] | None = None
+
+    def schedule(self, reference_ids: list[str]):
+        """Queue the traversals for the first top_n reference ids."""
+        loop = asyncio.get_running_loop()
+        for ident in reference_ids[: self.top_n]:
+            for name in self.traversals:
+                key = (name, ident)
+                if key in self.store:
+                    continue
+                self.store[key] = (time.monotonic(), loop.create_future())
+                self.queue.put_nowait(key)
+                self.stats.scheduled += 1
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.work())
+
+    async def work(self):
+        while True:
+            key = await self.queue.get()
+            await self.wait_for_tools()
+            entry = self.store.get(key)
+            # Skip anything a tool call has already claimed.
+            if entry is None or entry[1].done():
+                continue
+            future = entry[1]
+            self.running = key
+            name, ident = key
+            try:
+                result = await asyncio.to_thread(
+                    self.traversals[name], self.kuzudb, ident
+                )
+            except Exception:
+                # The tool call will run the traversal itself.
+                logfire.exception(
+                    "prefetch of {name} for {ident} failed", name=name, ident=ident
+                )
+                result = None
+            else:
+                self.stats.completed += 1
+            finally:
+                self.running = None
+            if not future.done():
+                future.set_result(result)
+
+    async def wait_for_tools(self):
+        """Wait until no tool call holds, or is waiting for, the tool lock."""
+        while self.tool_lock is not None and self.tool_lock.locked():
+            # The lock is fair, so this queues behind any waiting tool calls.
+            async with self.tool_lock:
+                pass
+
+    async def take(self, name: str, reference_id: str) -> list[LLMCitation] | None:
+        """The prefetched result, or None if the caller should run it."""
+        key = (name, reference_id)
+        entry = self.store.pop(key, None)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        created, future = entry
+        if time.monotonic() - created > self.ttl:
+            self.stats.misses += 1
+            self.count_wasted(future)
+            return None
+        if not future.done() and key != self.running:
+            # Still queued, so it is no quicker to wait for it.
+            future.cancel()
+            self.stats.misses += 1
+            return None
+        result = await future
+        if result is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return result
+
+    def close(self):
+        """Stop prefetching, and count what was never used."""
+        if self.worker is not None:
+            self.worker.cancel()
+        if self.running is not None:
+            self.kuzudb.interrupt()
+        for _, future in self.store.values():
+            self.count_wasted(future)
+            future.cancel()
+        self.store.clear()
+
+    def count_wasted(self, future: asyncio.Future[list[LLMCitation] | None]):
+        if future.done() and not future.cancelled() and future.result() is not None:
+            self.stats.wasted += 1
@@ -1,10 +1,11 @@
+import functools
 import re
 from typing import Self
 
 from lancedb import DBConnection
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from model import LLMResult
+from model import LLMCitation, LLMResult
 
 
 # We wrap the LLM result in a checked result.
@@ -12,6 +13,8 @@ from model import LLMResult
 class CheckedCitation(BaseModel):
     reference: str
     text: str
+    # Rendered blocks, by css class.
+    _blocks: dict[str | None, str] = PrivateAttr(default_factory=dict)
 
     def demoted_text(self, n: int = 1) -> list[str]:
         """Demote all the headings in the text by n levels."""
@@ -23,12 +26,42 @@ class CheckedCitation(BaseModel):
             demoted.append(dline)
         return demoted
 
+    def to_markdown(self, css_class: str | None = None) -> str:
+        """The citation as a markdown block, rendered once per css class."""
+        block = self._blocks.get(css_class)
+        if block is None:
+            txt = [f"\n<div class='{css_class}'>\n"] if css_class else ["---"]
+            txt.append(f"## {self.reference}")
+            txt.extend(self.demoted_text(2))
+            if css_class:
+                txt.append("</div>\n")
+            block = self._blocks[css_class] = "\n".join(txt)
+        return block
+
 
 # For some reason one of the acts has BILL-SCDRAFT in the reference.
 # Go figure.
 RE_REFERENCE = re.compile(
     r"(?:[A-Z]{1,15}\d{1,10}|BILL-SCDRAFT\d{1,10})-\d{1,7}-\d{1,5}"
 )
+# A reference, taking any brackets already around it.
+RE_LINKABLE = re.compile(rf"\[({RE_REFERENCE.pattern})\]|({RE_REFERENCE.pattern})")
+RE_DASHES = re.compile(r"[\u2013\u2014\u2212\u2012\u2010\u2043]")
+RE_PREFIX = re.compile(r"^([a-z]+)(\d+)")
+
+
+@functools.lru_cache(maxsize=4096)
+def reference_anchor(ref: str) -> str:
+    """The anchor streamlit gives the heading for a reference."""
+    # Replace different dash types with ASCII hyphen-minus "-"
+    text = RE_DASHES.sub("-", ref).lower()
+    # Add dash between any initial letter prefix and the first digit block
+    return RE_PREFIX.sub(r"\1-\2", text)
+
+
+def link_reference(match: re.Match[str]) -> str:
+    ref = match.group(1) or match.group(2)
+    return f"[{ref}](#{reference_anchor(ref)})"
 
 
 def build_checked_citations(
@@ -37,8 +70,13 @@ def build_checked_citations(
     errors = []
     checked = []
     table = db.open_table("phrases")
+    # A deduplicated table keeps the ids it collapsed as aliases.
+    has_aliases = "aliases" in table.schema.names
     for ref in refs:
-        cite_res = table.search().where(f"id = '{ref}'").limit(1).to_list()
+        where = f"id = '{ref}'"
+        if has_aliases:
+            where += f" OR array_has_any(aliases, ['{ref}'])"
+        cite_res = table.search().where(where).limit(1).to_list()
         if len(cite_res) == 0:
             errors.append(f"Could not find citation: {ref}")
         else:
@@ -59,6 +97,10 @@ class CheckedResult(BaseModel):
     errors: list[str]
     citations: list[CheckedCitation]
     was_structured: bool
+    # Why the research stopped early, if it did.
+    stopped: str = ""
+    # Rendered documents, by css class. Set the fields before rendering.
+    _markdown: dict[str | None, str] = PrivateAttr(default_factory=dict)
 
     @classmethod
     def from_llm_result(
@@ -72,6 +114,25 @@ class CheckedResult(BaseModel):
         slf.format_links()
         return slf
 
+    @classmethod
+    def from_stopped(cls, query: str, reason: str, found: list[LLMCitation]) -> Self:
+        """A result for research that stopped before the LLM answered.
+
+        The citations are what the tools found, straight from the databases.
+        """
+        return cls(
+            query=query,
+            question=query,
+            response="",
+            errors=[f"The research stopped before it reached an answer, as {reason}."],
+            citations=[
+                CheckedCitation(reference=cite.reference, text=cite.text)
+                for cite in found
+            ],
+            was_structured=False,
+            stopped=reason,
+        )
+
     @classmethod
     def _build_from_str(cls, query: str, result: str, db: DBConnection) -> Self:
         # Most important: Find the references.
@@ -136,68 +197,21 @@ class CheckedResult(BaseModel):
         return text
 
     def get_references_markdown(self, css_class: str | None = None) -> str:
-        txt = []
-        for c in self.citations:
-            if css_class:
-                txt.append(f"\n<div class='{css_class}'>\n")
-            else:
-                txt.append("---")
-            txt.append(f"## {c.reference}")
-            txt.extend(c.demoted_text(2))
-            if css_class:
-                txt.append("</div>\n")
-
-        return "\n".join(txt)
+        return "\n".join(c.to_markdown(css_class) for c in self.citations)
 
     def to_markdown(self, css_refs: str | None = None) -> str:
-        return (
-            self.get_response_markdown()
-            + "\n\n"
-            + self.get_references_markdown(css_refs)
-        )
+        """The whole document, built once and then reused."""
+        md = self._markdown.get(css_refs)
+        if md is None:
+            md = self._markdown[css_refs] = (
+                self.get_response_markdown()
+                + "\n\n"
+                + self.get_references_markdown(css_refs)
+            )
+        return md
 
     def format_links(self):
         """Format references in the text as markdown links."""
-        # First, find all references in the text
-        text = self.response
-        references = RE_REFERENCE.finditer(text)
-
-        def transform_anchor(text: str) -> str:
-            # We need to transform the text into an anchor
-            # This follows the way that streamlit does it.
-            # Replace different dash types with ASCII hyphen-minus "-"
-            text = re.sub(r"[\u2013\u2014\u2212\u2012\u2010\u2043]", "-", text)
-            # Lowercase all letters
-            text = text.lower()
-            # Add dash between any initial letter prefix and the first digit block
-            text = re.sub(r"^([a-z]+)(\d+)", r"\1-\2", text)
-            return text
-
-        # Process the text from end to beginning to avoid offset issues
-        # when making multiple replacements
-        replacements = []
-        for match in references:
-            start, end = match.span()
-            ref = match.group()
-            anchor = transform_anchor(ref)
-
-            # Check if the reference is already in brackets
-            pre_char = text[start - 1 : start] if start > 0 else ""
-            post_char = text[end : end + 1] if end < len(text) else ""
-
-            if pre_char == "[" and post_char == "]":
-                # Already in brackets, just add the link
-                replacements.append((start - 1, end + 1, f"[{ref}](#{anchor})"))
-            else:
-                # Not in brackets, add brackets and link
-                replacements.append((start, end, f"[{ref}](#{anchor})"))
-
-        # Sort replacements in reverse order (from end to beginning)
-        replacements.sort(key=lambda x: x[0], reverse=True)
-
-        # Apply replacements
-        result = text
-        for start, end, replacement in replacements:
-            result = result[:start] + replacement + result[end:]
-
-        self.response = result
+        # One pass, replacing any brackets already around a reference.
+        self.response = RE_LINKABLE.sub(link_reference, self.response)
+        self._markdown.clear()